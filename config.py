@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kindle OCR Configuration
+
+Loads settings shared by the processing scripts from config.env.
+"""
+
+import re
+from functools import lru_cache
+from pathlib import Path
+
+# KEY=value lines; blank lines and lines starting with # are skipped
+CONFIG_LINE_RE = re.compile(r'^[ \t]*([^#\s=][^=\n]*?)[ \t]*=(.*)$', re.MULTILINE)
+
+
+@lru_cache(maxsize=None)
+def load_config(config_path='config.env'):
+    """Load configuration from config.env file.
+
+    The file is parsed once per path; later calls return the same dict.
+    """
+    config = {}
+    config_file = Path(config_path)
+
+    if not config_file.exists():
+        return config
+
+    try:
+        data = config_file.read_bytes().decode('utf-8')
+        for match in CONFIG_LINE_RE.finditer(data):
+            key, value = match.groups()
+            # Remove quotes if present
+            config[key] = value.strip().strip('"').strip("'")
+    except Exception as e:
+        print(f"Warning: Could not read config file {config_path}: {e}")
+
+    return config
@@ -6,34 +6,103 @@ Kindle OCR Processing Script
 Processes screenshots from Kindle app using Google Gemini API for OCR.
 """
 
+import io
+import os
+import re
 import sys
+import asyncio
 import argparse
-import base64
+import hashlib
+import heapq
+import tempfile
 from pathlib import Path
 import google.generativeai as genai
+import imagehash
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError
+from PIL import Image
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
+from config import load_config
 
-def load_config(config_path='config.env'):
-    """Load configuration from config.env file."""
-    config = {}
-    config_file = Path(config_path)
+GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
 
-    if not config_file.exists():
-        return config
+# Maximum number of Gemini OCR requests in flight at once
+DEFAULT_CONCURRENCY = 8
 
-    try:
-        with open(config_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    # Remove quotes if present
-                    value = value.strip().strip('"').strip("'")
-                    config[key.strip()] = value
-    except Exception as e:
-        print(f"Warning: Could not read config file {config_path}: {e}")
+# Number of screenshots sent to Gemini in a single request
+DEFAULT_BATCH_SIZE = 4
+
+# Attempts per Gemini request when it fails with a rate limit or server error
+MAX_ATTEMPTS = 5
+
+# Transient Gemini API errors worth retrying: 429 rate limits (including
+# ResourceExhausted) and 500/502/503/504 server errors, but not 501 Not Implemented
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+)
+
+# The same errors as HTTP status codes, for Files API uploads, which raise
+# googleapiclient HttpError rather than google.api_core exceptions
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# JPEG quality used when re-encoding screenshots before sending them (0 sends the PNG as is)
+DEFAULT_JPEG_QUALITY = 85
+
+# Batches whose images add up to more than this many bytes go through the Files API
+# instead of inline; Gemini rejects inline requests over 20 MB, prompt included
+MAX_INLINE_BYTES = 19 * 1024 * 1024
+
+# OCR results are cached here, keyed by a hash of the model, prompt and image
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'ocr-kindle'
+
+# Side of the perceptual hash grid; 16 gives 256-bit hashes, enough to tell apart
+# different text pages that share the same layout
+DUPLICATE_HASH_SIZE = 16
+
+# Perceptual hashes closer than this (in bits) mark a screenshot as a duplicate of the page before it
+DUPLICATE_HASH_DISTANCE = 12
+
+# Page number in screenshot_<n>.png and ocr_<n>.txt filenames
+FILE_NUMBER_RE = re.compile(r'(?:screenshot|ocr)_(\d+)\.(?:png|txt)')
+
+# Delimiter Gemini places before the text of page k in a batched response
+PAGE_DELIMITER_RE = re.compile(r'^[ \t]*===PAGE (\d+)===[ \t]*$', re.MULTILINE)
+
+# Prompt for OCR - focus on main content, ignore system UI, fix spacing.
+# Hoisted into a constant system_instruction set once on the model rather than
+# repeated in every request. At about 300 tokens it is too short for Gemini's
+# explicit or implicit context caching, which need a prefix of at least 1024.
+OCR_PROMPT = """Extract only the main book/document content from each of the following Kindle app screenshots.
+
+IGNORE:
+- System toolbar, menu bar, status bar
+- Time, date, battery indicators
+- Window controls, buttons
+- File menu items (File, Edit, View, etc.)
+- Any UI elements outside the main reading area
 
-    return config
+EXTRACT ONLY:
+- The actual book text content
+- Chapter titles, headings
+- Main body text, paragraphs
+- Any text that is part of the actual book/document being read
+
+IMPORTANT FORMATTING:
+- Fix any unnecessary spacing between characters in words
+- Ensure proper word spacing and sentence flow
+- Join fragmented words that should be together
+- Maintain natural paragraph breaks
+- Keep the text readable and properly formatted
+
+Each screenshot is preceded by a ---PAGE k--- label. For every screenshot, output a line
+===PAGE k=== (with the same k) followed by the text of that page, in the same order.
+
+Return only the clean, properly-spaced text content without OCR artifacts or formatting instructions."""
 
 
 def setup_gemini_client(api_key):
@@ -42,91 +111,326 @@ def setup_gemini_client(api_key):
         raise ValueError("Gemini API key is required")
 
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
+    model = genai.GenerativeModel(GEMINI_MODEL, system_instruction=OCR_PROMPT)
     return model
 
 
-def perform_ocr(gemini_model, image_path, save_individual=True):
-    """Perform OCR on a single image using Gemini and optionally save individual file."""
+def extract_file_number(filepath):
+    """Return the page number of a screenshot_<n>.png or ocr_<n>.txt file, or 0 if it has none."""
+    match = FILE_NUMBER_RE.fullmatch(filepath.name)
+    return int(match.group(1)) if match else 0
+
+
+def write_ocr_file(image_path, text_content):
+    """Write the OCR text for an image next to it: screenshot_001.png -> ocr_001.txt."""
+    image_path_obj = Path(image_path)
+    ocr_filename = image_path_obj.stem.replace('screenshot_', 'ocr_') + '.txt'
+    ocr_path = image_path_obj.parent / ocr_filename
+
+    with open(ocr_path, 'w', encoding='utf-8') as ocr_file:
+        ocr_file.write(text_content)
+    return ocr_filename
+
+
+def ocr_cache_key(image_path, jpeg_quality):
+    """Return the cache key for an image: a SHA-256 over the model, prompt, JPEG quality and image bytes.
+
+    Changing the model, the prompt or the image encoding invalidates earlier results.
+    """
+    with open(image_path, 'rb') as image_file:
+        image_data = image_file.read()
+
+    digest = hashlib.sha256()
+    digest.update(f'{GEMINI_MODEL}\n{OCR_PROMPT}\n{jpeg_quality}\n'.encode('utf-8'))
+    digest.update(image_data)
+    return digest.hexdigest()
+
+
+def load_cached_ocr(image_paths, cache_dir, jpeg_quality):
+    """Look up cached OCR results for images.
+
+    Returns a dict of image path to cache key and a dict of image path to
+    cached text for the images that were found in the cache.
+    """
+    cache_keys = {}
+    cached_texts = {}
+    for image_path in image_paths:
+        cache_key = ocr_cache_key(image_path, jpeg_quality)
+        cache_keys[image_path] = cache_key
+        cache_file = Path(cache_dir) / f'{cache_key}.txt'
+        if cache_file.exists():
+            text_content = cache_file.read_text(encoding='utf-8')
+            # An empty entry is not a valid result; OCR the image again
+            if text_content:
+                cached_texts[image_path] = text_content
+    return cache_keys, cached_texts
+
+
+def save_cached_ocr(cache_dir, cache_keys, image_paths, page_texts):
+    """Store OCR results in the cache. Empty results are not cached so they are retried.
+
+    Each entry is written to a temporary file in ``cache_dir`` and renamed into
+    place, so a run that dies mid-write never leaves a truncated entry behind.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for image_path, text_content in zip(image_paths, page_texts):
+        if text_content:
+            cache_file = cache_dir / f'{cache_keys[image_path]}.txt'
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as temp_file:
+                    temp_file.write(text_content)
+                os.replace(temp_path, cache_file)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+
+def find_duplicate_pages(image_paths, max_distance=DUPLICATE_HASH_DISTANCE):
+    """Find screenshots that repeat the page before them, e.g. after a slow page turn.
+
+    Each image's perceptual hash is compared with the last page that was not
+    a duplicate. Returns a dict mapping each duplicate image path to the path
+    of the page it repeats.
+    """
+    duplicates = {}
+    source_path = None
+    source_hash = None
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            image_hash = imagehash.phash(image, hash_size=DUPLICATE_HASH_SIZE)
+        if source_hash is not None and image_hash - source_hash < max_distance:
+            duplicates[image_path] = source_path
+        else:
+            source_path = image_path
+            source_hash = image_hash
+    return duplicates
+
+
+def completed_batch_pages(text):
+    """Return the texts of pages in a partially received batched response that are complete.
+
+    A page is complete once the ``===PAGE k===`` delimiter of the page after
+    it has arrived. Stops at the first delimiter that is out of sequence.
+    """
+    parts = PAGE_DELIMITER_RE.split(text)
+    page_texts = []
+    for i, number in enumerate(parts[1:-2:2]):
+        if int(number) != i + 1:
+            break
+        page_texts.append(parts[2 * i + 2].strip())
+    return page_texts
+
+
+def split_batch_response(text, page_count):
+    """Split a batched Gemini response into per-page texts.
+
+    Returns None if the response does not contain exactly one ``===PAGE k===``
+    section for each page, in order.
+    """
+    parts = PAGE_DELIMITER_RE.split(text)
+    # parts = [preamble, '1', page_1_text, '2', page_2_text, ...]
+    numbers = [int(number) for number in parts[1::2]]
+    if numbers != list(range(1, page_count + 1)):
+        # A single page may come back without its delimiter
+        if page_count == 1 and not numbers:
+            return [text.strip()]
+        return None
+    return [page_text.strip() for page_text in parts[2::2]]
+
+
+def encode_jpeg(image_path, quality):
+    """Re-encode a screenshot as JPEG, returning the encoded bytes."""
+    buffer = io.BytesIO()
+    with Image.open(image_path) as image:
+        image.convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def encode_image(image_path, jpeg_quality):
+    """Return the MIME type and bytes to send for a screenshot, as JPEG unless jpeg_quality is 0."""
+    if not jpeg_quality:
+        return 'image/png', Path(image_path).read_bytes()
+    return 'image/jpeg', encode_jpeg(image_path, jpeg_quality)
+
+
+def is_retryable(error):
+    """Return True for transient Gemini API errors (see RETRYABLE_ERRORS and RETRYABLE_STATUSES)."""
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def log_retry(retry_state):
+    """Report a transient Gemini error before tenacity waits to retry it."""
+    print(f'Gemini request failed ({retry_state.outcome.exception()}); '
+          f'retrying in {retry_state.next_action.sleep:.1f}s '
+          f'(attempt {retry_state.attempt_number}/{MAX_ATTEMPTS})')
+
+
+@retry(retry=retry_if_exception(is_retryable), stop=stop_after_attempt(MAX_ATTEMPTS),
+       wait=wait_exponential_jitter(), before_sleep=log_retry, reraise=True)
+def upload_file(image_path, mime_type, data):
+    """Upload an encoded screenshot to the Gemini Files API, retrying transient errors."""
+    return genai.upload_file(io.BytesIO(data), mime_type=mime_type, display_name=Path(image_path).name)
+
+
+async def upload_image(image_path, uploads, mime_type, data):
+    """Upload an image to the Gemini Files API, reusing an earlier upload of the same path.
+
+    ``uploads`` maps image paths to uploaded file handles.
+    """
+    file_ref = uploads.get(image_path)
+    if file_ref is None:
+        file_ref = await asyncio.to_thread(upload_file, image_path, mime_type, data)
+        uploads[image_path] = file_ref
+    return file_ref
+
+
+async def image_parts(image_paths, uploads, jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """Return the request parts for a batch of screenshots.
+
+    Images are sent inline as raw bytes, which takes no requests besides the
+    OCR request itself. Only a batch too large to send inline (see
+    MAX_INLINE_BYTES) is uploaded through the Files API, with the handles
+    kept in ``uploads`` so a page that is retried is not uploaded again.
+    """
+    encoded = await asyncio.gather(*[
+        asyncio.to_thread(encode_image, image_path, jpeg_quality) for image_path in image_paths
+    ])
+    if sum(len(data) for _, data in encoded) <= MAX_INLINE_BYTES:
+        return [{'mime_type': mime_type, 'data': data} for mime_type, data in encoded]
+
+    return await asyncio.gather(*[
+        upload_image(image_path, uploads, mime_type, data)
+        for image_path, (mime_type, data) in zip(image_paths, encoded)
+    ])
+
+
+async def delete_uploads(uploads):
+    """Delete all uploaded file handles from the Gemini Files API."""
+    async def delete(image_path, file_ref):
+        try:
+            await asyncio.to_thread(genai.delete_file, file_ref.name)
+        except Exception as e:
+            print(f'Warning: Could not delete upload for {image_path}: {e}')
+
+    await asyncio.gather(*[delete(image_path, file_ref) for image_path, file_ref in uploads.items()])
+    uploads.clear()
+
+
+async def save_ocr_file(image_path, text_content):
+    """Write an image's OCR file in a worker thread, reporting rather than raising errors."""
+    try:
+        ocr_filename = await asyncio.to_thread(write_ocr_file, image_path, text_content)
+        print(f'Individual OCR saved: {ocr_filename}')
+    except Exception as e:
+        print(f'Error saving OCR for {image_path}: {e}')
+
+
+@retry(retry=retry_if_exception(is_retryable), stop=stop_after_attempt(MAX_ATTEMPTS),
+       wait=wait_exponential_jitter(), before_sleep=log_retry, reraise=True)
+async def stream_ocr_batch(gemini_model, contents, image_paths, save_individual=True):
+    """Stream a batched OCR response, saving each page's file as soon as it is complete.
+
+    A page is complete once the next page starts arriving. Returns the full
+    response text and the number of leading pages already handled. Rate limit
+    (429) and server (5xx) errors restart the request with exponential backoff
+    and jitter; other errors are raised immediately.
+    """
+    saves = []
+    saved_pages = 0
+    received = []
     try:
-        with open(image_path, 'rb') as image_file:
-            image_data = image_file.read()
-
-        # Encode image to base64
-        image_b64 = base64.b64encode(image_data).decode()
-
-        # Create image part for Gemini
-        image_part = {
-            'mime_type': 'image/png',
-            'data': image_b64
-        }
-
-        # Prompt for OCR - focus on main content, ignore system UI, fix spacing
-        prompt = """Extract only the main book/document content from this Kindle app screenshot.
-
-        IGNORE:
-        - System toolbar, menu bar, status bar
-        - Time, date, battery indicators
-        - Window controls, buttons
-        - File menu items (File, Edit, View, etc.)
-        - Any UI elements outside the main reading area
-
-        EXTRACT ONLY:
-        - The actual book text content
-        - Chapter titles, headings
-        - Main body text, paragraphs
-        - Any text that is part of the actual book/document being read
-
-        IMPORTANT FORMATTING:
-        - Fix any unnecessary spacing between characters in words
-        - Ensure proper word spacing and sentence flow
-        - Join fragmented words that should be together
-        - Maintain natural paragraph breaks
-        - Keep the text readable and properly formatted
-
-        Return only the clean, properly-spaced text content without OCR artifacts or formatting instructions."""
-
-        response = gemini_model.generate_content([prompt, image_part])
-
-        text_content = response.text.strip() if response.text else ''
-
-        # Save individual OCR file if requested
-        if save_individual and text_content:
-            image_path_obj = Path(image_path)
-            # Create individual OCR filename: screenshot_001.png -> ocr_001.txt or screenshot_1.png -> ocr_1.txt
-            ocr_filename = image_path_obj.stem.replace('screenshot_', 'ocr_') + '.txt'
-            ocr_path = image_path_obj.parent / ocr_filename
-
-            with open(ocr_path, 'w', encoding='utf-8') as ocr_file:
-                ocr_file.write(text_content)
-            print(f'Individual OCR saved: {ocr_filename}')
-
-        return text_content
+        response = await gemini_model.generate_content_async(contents, stream=True)
+        async for chunk in response:
+            if chunk.candidates and chunk.parts:
+                received.append(chunk.text)
+
+            # Save pages that are complete while the rest of the response streams in
+            if save_individual:
+                completed = completed_batch_pages(''.join(received))[:len(image_paths)]
+                for image_path, text_content in zip(image_paths[saved_pages:], completed[saved_pages:]):
+                    if text_content:
+                        saves.append(asyncio.create_task(save_ocr_file(image_path, text_content)))
+                saved_pages = max(saved_pages, len(completed))
+    finally:
+        # Let page saves finish before returning or retrying, so they cannot overwrite later results
+        await asyncio.gather(*saves)
+
+    return ''.join(received), saved_pages
+
+
+async def perform_ocr_batch(gemini_model, image_paths, semaphore, uploads,
+                            jpeg_quality=DEFAULT_JPEG_QUALITY, save_individual=True):
+    """Perform OCR on a batch of images with one Gemini request and optionally save individual files.
+
+    Images are re-encoded as JPEG at ``jpeg_quality`` and sent inline, or
+    through the Files API if the batch is too large (see image_parts). Any
+    uploads and the Gemini request run under ``semaphore`` so that concurrent
+    calls stay within the API rate limits, including while waiting to retry a
+    transient error. The response is streamed (see stream_ocr_batch). If a multi-page batch fails or its
+    response cannot be split into pages, each page is retried on its own.
+    """
+    saved_pages = 0
+    try:
+        async with semaphore:
+            names = ', '.join(Path(image_path).name for image_path in image_paths)
+            print(f'Processing images: {names}')
+            parts = await image_parts(image_paths, uploads, jpeg_quality)
+
+            contents = []
+            for page_number, part in enumerate(parts, 1):
+                contents.append(f'---PAGE {page_number}---')
+                contents.append(part)
+
+            response_text, saved_pages = await stream_ocr_batch(
+                gemini_model, contents, image_paths, save_individual
+            )
+
+        if not response_text:
+            raise ValueError('Empty response from Gemini')
+
+        page_texts = split_batch_response(response_text, len(image_paths))
+        if page_texts is None:
+            raise ValueError(f'Expected {len(image_paths)} ===PAGE k=== sections in response')
     except Exception as e:
-        print(f'Error processing {image_path}: {e}')
+        if len(image_paths) > 1:
+            print(f'Error processing batch {image_paths[0]}..{image_paths[-1]}: {e}; retrying pages individually')
+            results = await asyncio.gather(*[
+                perform_ocr_batch(gemini_model, [image_path], semaphore, uploads,
+                                  jpeg_quality, save_individual)
+                for image_path in image_paths
+            ])
+            return [texts[0] for texts in results]
+
+        print(f'Error processing {image_paths[0]}: {e}')
         # Still create an empty individual file to maintain sequence
         if save_individual:
-            image_path_obj = Path(image_path)
-            ocr_filename = image_path_obj.stem.replace('screenshot_', 'ocr_') + '.txt'
-            ocr_path = image_path_obj.parent / ocr_filename
-            with open(ocr_path, 'w', encoding='utf-8') as ocr_file:
-                ocr_file.write('')
+            ocr_filename = await asyncio.to_thread(write_ocr_file, image_paths[0], '')
             print(f'Empty OCR file created due to error: {ocr_filename}')
-        return ''
+        return ['']
+
+    # Save the remaining individual OCR files if requested
+    if save_individual:
+        await asyncio.gather(*[
+            save_ocr_file(image_path, text_content)
+            for image_path, text_content in zip(image_paths[saved_pages:], page_texts[saved_pages:])
+            if text_content
+        ])
+
+    return page_texts
 
 
 def merge_ocr_files(folder_path):
-    """Merge individual OCR files into a single ocr_output.txt file."""
+    """Rebuild ocr_output.txt from the individual OCR files, e.g. after editing them by hand."""
     folder = Path(folder_path)
-    ocr_files = list(folder.glob('ocr_*.txt'))
+    ocr_output_file = folder / 'ocr_output.txt'
+    ocr_files = [p for p in folder.glob('ocr_*.txt') if p != ocr_output_file]
 
     # Sort OCR files by number to maintain order
-    def extract_number(filename):
-        import re
-        match = re.search(r'ocr_(\d+)\.txt', filename.name)
-        return int(match.group(1)) if match else 0
-
-    ocr_files.sort(key=extract_number)
+    ocr_files.sort(key=extract_file_number)
 
     if not ocr_files:
         print("No individual OCR files found to merge")
@@ -134,83 +438,227 @@ def merge_ocr_files(folder_path):
 
     print(f"Merging {len(ocr_files)} OCR files...")
 
-    merged_text = ''
-    ocr_output_file = folder / 'ocr_output.txt'
-
-    with open(ocr_output_file, 'w', encoding='utf-8') as output:
-        for ocr_file in ocr_files:
-            try:
-                with open(ocr_file, 'r', encoding='utf-8') as f:
-                    content = f.read().strip()
-                    if content:
-                        merged_text += content + '\n'
-                        output.write(content + '\n')
-                print(f"Merged: {ocr_file.name}")
-            except Exception as e:
-                print(f"Error reading {ocr_file.name}: {e}")
+    # Collect page texts and join once, rather than growing a string per page
+    parts = []
+    for ocr_file in ocr_files:
+        try:
+            # Pages that failed OCR are left as empty files; skip them without opening
+            if ocr_file.stat().st_size:
+                content = ocr_file.read_text(encoding='utf-8').strip()
+                if content:
+                    parts.append(content)
+                    parts.append('\n')
+            print(f"Merged: {ocr_file.name}")
+        except Exception as e:
+            print(f"Error reading {ocr_file.name}: {e}")
+
+    merged_text = ''.join(parts)
+    with open(ocr_output_file, 'w', encoding='utf-8', buffering=1 << 20) as output:
+        output.write(merged_text)
 
     print(f"Merged OCR saved to: {ocr_output_file}")
     return merged_text, ocr_output_file
 
 
-def process_images(folder_path, gemini_model):
-    """Process all screenshot images in the folder, creating individual OCR files."""
+async def write_ocr_output(ocr_output_file, page_count, results, pages=None):
+    """Write OCR results to ocr_output.txt in page order as they arrive.
+
+    ``results`` is an asyncio.Queue of (page index, text) tuples put in any
+    order. Pages are held back until all earlier pages have arrived, then
+    written together. If ``pages`` is given, each non-empty page text is also
+    put on it in page order, followed by None once all pages are written.
+    Returns the merged text.
+    """
+    parts = []
+    ready = []
+    next_index = 0
+    with open(ocr_output_file, 'w', encoding='utf-8', buffering=1 << 20) as output:
+        while next_index < page_count:
+            heapq.heappush(ready, await results.get())
+
+            # Write the run of pages that is now contiguous with what was written so far
+            run = []
+            while ready and ready[0][0] == next_index:
+                _, text_content = heapq.heappop(ready)
+                if text_content:
+                    run.append(text_content)
+                next_index += 1
+
+            if run:
+                chunk = ''.join(text_content + '\n' for text_content in run)
+                await asyncio.to_thread(output.write, chunk)
+                parts.append(chunk)
+                if pages is not None:
+                    for text_content in run:
+                        pages.put_nowait(text_content)
+
+    if pages is not None:
+        pages.put_nowait(None)
+    return ''.join(parts)
+
+
+async def process_images(folder_path, gemini_model, concurrency=DEFAULT_CONCURRENCY,
+                         batch_size=DEFAULT_BATCH_SIZE, jpeg_quality=DEFAULT_JPEG_QUALITY,
+                         cache_dir=DEFAULT_CACHE_DIR, skip_duplicates=False, pages=None):
+    """Process all screenshot images in the folder, creating individual and merged OCR files.
+
+    With ``skip_duplicates``, screenshots that look the same as the page
+    before them are not sent to Gemini and reuse that page's text instead.
+    Images already OCR'd with the same model and prompt are taken from
+    ``cache_dir`` (pass None to disable the cache). The remaining images are
+    grouped into batches of ``batch_size`` per Gemini request and the batches
+    are sent concurrently, with at most ``concurrency`` requests in flight at
+    a time. Each page is written to its ocr_*.txt file and streamed into
+    ocr_output.txt in page order as results arrive. If ``pages`` is given,
+    page texts are also put on it in order for a downstream consumer (see
+    write_ocr_output).
+    """
     folder = Path(folder_path)
     image_files = list(folder.glob('screenshot_*.png'))
 
-    # Sort numerically by extracting number from filename
-    def extract_screenshot_number(filepath):
-        import re
-        match = re.search(r'screenshot_(\d+)\.png', filepath.name)
-        return int(match.group(1)) if match else 0
-
-    image_files.sort(key=extract_screenshot_number)  # Numeric ordering
+    image_files.sort(key=extract_file_number)  # Numeric ordering
 
     if not image_files:
         raise ValueError(f"No screenshot images found in {folder_path}")
 
     print(f"Found {len(image_files)} images to process")
 
-    # Process each image individually, saving separate OCR files
-    for i, image_path in enumerate(image_files, 1):
-        print(f'Processing image {i}/{len(image_files)}: {image_path.name}')
-        perform_ocr(gemini_model, str(image_path), save_individual=True)
-
-    print("Individual OCR processing completed")
+    image_paths = [str(image_path) for image_path in image_files]
+    page_indexes = {image_path: i for i, image_path in enumerate(image_paths)}
+    ocr_output_file = folder / 'ocr_output.txt'
+    results = asyncio.Queue()
+    writer = asyncio.create_task(write_ocr_output(ocr_output_file, len(image_paths), results, pages))
+
+    # Leave out screenshots that repeat the previous page; they get that page's text
+    duplicates_of = {}
+    if skip_duplicates:
+        duplicates = await asyncio.to_thread(find_duplicate_pages, image_paths)
+        for image_path, source_path in duplicates.items():
+            duplicates_of.setdefault(source_path, []).append(image_path)
+            print(f"Skipping {Path(image_path).name}: duplicate of {Path(source_path).name}")
+        if duplicates:
+            print(f"Skipping {len(duplicates)} duplicate screenshots")
+        image_paths = [p for p in image_paths if p not in duplicates]
+
+    async def add_results(batch, page_texts):
+        for image_path, text_content in zip(batch, page_texts):
+            results.put_nowait((page_indexes[image_path], text_content))
+            for duplicate_path in duplicates_of.get(image_path, []):
+                results.put_nowait((page_indexes[duplicate_path], text_content))
+                await asyncio.to_thread(write_ocr_file, duplicate_path, text_content)
+
+    # Reuse cached OCR results for images that were processed before
+    cache_keys = {}
+    if cache_dir:
+        cache_keys, cached_texts = await asyncio.to_thread(
+            load_cached_ocr, image_paths, cache_dir, jpeg_quality
+        )
+        await asyncio.gather(*[
+            asyncio.to_thread(write_ocr_file, image_path, text_content)
+            for image_path, text_content in cached_texts.items()
+        ])
+        await add_results(list(cached_texts), list(cached_texts.values()))
+        if cached_texts:
+            print(f"Reused cached OCR for {len(cached_texts)}/{len(image_paths)} images")
+        image_paths = [p for p in image_paths if p not in cached_texts]
+
+    async def process_batch(batch):
+        page_texts = await perform_ocr_batch(gemini_model, batch, semaphore, uploads,
+                                             jpeg_quality, save_individual=True)
+        await add_results(batch, page_texts)
+        if cache_dir:
+            try:
+                await asyncio.to_thread(save_cached_ocr, cache_dir, cache_keys, batch, page_texts)
+            except Exception as e:
+                print(f"Warning: Could not cache OCR results: {e}")
 
-    # Now merge all individual OCR files
-    return merge_ocr_files(folder_path)
+    # Process batches of images concurrently, saving separate OCR files
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    semaphore = asyncio.Semaphore(concurrency)
+    uploads = {}
+    try:
+        await asyncio.gather(*[process_batch(batch) for batch in batches])
+    except BaseException:
+        writer.cancel()
+        raise
+    finally:
+        await delete_uploads(uploads)
+
+    merged_text = await writer
+    print("OCR processing completed")
+    print(f"Merged OCR saved to: {ocr_output_file}")
+    return merged_text, ocr_output_file
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Process Kindle screenshots with OCR')
-    parser.add_argument('folder_path', help='Path to folder containing screenshots')
-    parser.add_argument('--gemini-api-key', required=False,
-                       help='Google Gemini API key (defaults to config.env)')
+def run(folder_path, api_key=None, gemini_model=None, concurrency=DEFAULT_CONCURRENCY,
+        batch_size=DEFAULT_BATCH_SIZE, jpeg_quality=DEFAULT_JPEG_QUALITY,
+        cache_dir=DEFAULT_CACHE_DIR, skip_duplicates=False, rebuild_merge=False):
+    """OCR a folder of screenshots and return the merged text and ocr_output.txt path.
 
-    args = parser.parse_args()
+    Errors are raised rather than exiting, so other scripts can call this
+    in-process. Pass ``gemini_model`` to reuse an already configured model;
+    otherwise one is set up from ``api_key`` or config.env.
+    """
+    folder_path = Path(folder_path)
+    if not folder_path.exists():
+        raise FileNotFoundError(f"Folder not found: {folder_path}")
 
-    try:
-        # Load configuration
-        config = load_config()
+    print(f"Processing folder: {folder_path}")
 
-        # Setup
-        folder_path = Path(args.folder_path)
-        if not folder_path.exists():
-            raise FileNotFoundError(f"Folder not found: {folder_path}")
+    if rebuild_merge:
+        # Merge existing individual OCR files without calling Gemini
+        return merge_ocr_files(folder_path)
 
-        print(f"Processing folder: {folder_path}")
+    if concurrency < 1:
+        raise ValueError("--concurrency must be at least 1")
+    if batch_size < 1:
+        raise ValueError("--batch-size must be at least 1")
+    if not 0 <= jpeg_quality <= 95:
+        raise ValueError("--jpeg-quality must be between 0 and 95")
 
+    if gemini_model is None:
         # Get API key from args or config
-        api_key = args.gemini_api_key or config.get('GEMINI_API_KEY')
+        api_key = api_key or load_config().get('GEMINI_API_KEY')
         if not api_key:
             raise ValueError("Gemini API key is required. Set it in config.env or use --gemini-api-key")
 
         # Initialize Google Gemini API
         gemini_model = setup_gemini_client(api_key)
 
-        # Process images with OCR
-        ocr_text, ocr_output_file = process_images(folder_path, gemini_model)
+    # Process images with OCR
+    return asyncio.run(
+        process_images(folder_path, gemini_model, concurrency, batch_size, jpeg_quality, cache_dir,
+                       skip_duplicates)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process Kindle screenshots with OCR')
+    parser.add_argument('folder_path', help='Path to folder containing screenshots')
+    parser.add_argument('--gemini-api-key', required=False,
+                       help='Google Gemini API key (defaults to config.env)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                       help=f'Maximum concurrent Gemini requests (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                       help=f'Screenshots sent per Gemini request (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--jpeg-quality', type=int, default=DEFAULT_JPEG_QUALITY,
+                       help=f'JPEG quality for screenshots sent to Gemini, 0 to send PNGs as is (default: {DEFAULT_JPEG_QUALITY})')
+    parser.add_argument('--no-cache', action='store_true',
+                       help=f'Do not reuse or store OCR results in {DEFAULT_CACHE_DIR}')
+    parser.add_argument('--skip-duplicates', action='store_true',
+                       help='Reuse the previous page\'s text for screenshots that look identical to it')
+    parser.add_argument('--rebuild-merge', action='store_true',
+                       help='Skip OCR and rebuild ocr_output.txt from existing ocr_*.txt files')
+
+    args = parser.parse_args()
+
+    try:
+        ocr_text, ocr_output_file = run(
+            args.folder_path, args.gemini_api_key,
+            concurrency=args.concurrency, batch_size=args.batch_size, jpeg_quality=args.jpeg_quality,
+            cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR,
+            skip_duplicates=args.skip_duplicates, rebuild_merge=args.rebuild_merge
+        )
 
         if not ocr_text.strip():
             print("Warning: No text extracted from images")
@@ -218,7 +666,7 @@ def main():
 
         print(f"\nOCR processing completed successfully!")
         print(f"Merged OCR file: {ocr_output_file}")
-        print(f"Individual OCR files saved in: {folder_path}")
+        print(f"Individual OCR files saved in: {args.folder_path}")
 
     except Exception as e:
         print(f"Error: {e}")
@@ -7,10 +7,30 @@ Convenience script that chains OCR processing and markdown conversion.
 """
 
 import sys
+import asyncio
 import argparse
-import subprocess
 from pathlib import Path
 
+import img2txt
+import txt2md
+from config import load_config
+
+
+async def run_pipeline(folder_path, gemini_model, gemini_client):
+    """Run OCR and markdown conversion concurrently.
+
+    Pages are handed from the OCR stage to the markdown stage in page order
+    as soon as they are OCR'd, so markdown conversion of earlier pages
+    overlaps OCR of later ones. Returns the OCR output file and the markdown
+    content.
+    """
+    pages = asyncio.Queue()
+    (_, ocr_output_file), markdown_content = await asyncio.gather(
+        img2txt.process_images(folder_path, gemini_model, pages=pages),
+        txt2md.convert_pages(gemini_client, pages),
+    )
+    return ocr_output_file, markdown_content
+
 
 def main():
     parser = argparse.ArgumentParser(description='Process Kindle screenshots: OCR then Markdown conversion')
@@ -27,45 +47,52 @@ def main():
     args = parser.parse_args()
 
     try:
-        # Step 1: Run OCR processing
-        print("=== Step 1: OCR Processing ===")
-        ocr_cmd = [sys.executable, 'img2txt.py', args.folder_path]
-        if args.gemini_api_key:
-            ocr_cmd.extend(['--gemini-api-key', args.gemini_api_key])
-
-        result = subprocess.run(ocr_cmd, check=True)
-        print("OCR processing completed successfully!")
-
-        # Step 2: Run markdown conversion
-        print("\n=== Step 2: Markdown Conversion ===")
-        ocr_output_file = Path(args.folder_path) / 'ocr_output.txt'
-
-        if not ocr_output_file.exists():
-            raise FileNotFoundError(f"OCR output file not found: {ocr_output_file}")
-
-        markdown_cmd = [sys.executable, 'txt2md.py', str(ocr_output_file)]
-        if args.gemini_api_key:
-            markdown_cmd.extend(['--gemini-api-key', args.gemini_api_key])
-        if args.drive_folder:
-            markdown_cmd.extend(['--drive-folder', args.drive_folder])
+        # Load configuration
+        config = load_config()
+
+        folder_path = Path(args.folder_path)
+        if not folder_path.exists():
+            raise FileNotFoundError(f"Folder not found: {folder_path}")
+
+        # Get API key from args or config
+        api_key = args.gemini_api_key or config.get('GEMINI_API_KEY')
+        if not api_key:
+            raise ValueError("Gemini API key is required. Set it in config.env or use --gemini-api-key")
+
+        # Markdown goes to the Google Drive folder unless skipped
         if args.skip_drive:
-            markdown_cmd.append('--skip-drive')
-        if args.output_name:
-            markdown_cmd.extend(['--output-name', args.output_name])
+            output_folder = folder_path
+        else:
+            output_folder = args.drive_folder or config.get('GOOGLE_DRIVE_FOLDER')
+            if not output_folder:
+                raise ValueError("GOOGLE_DRIVE_FOLDER must be set in config.env or use --drive-folder")
+
+        gemini_model = img2txt.setup_gemini_client(api_key)
+        gemini_client = txt2md.setup_gemini_client(api_key)
+
+        # Step 1: Run OCR and markdown conversion as one pipeline
+        print("=== Step 1: OCR Processing and Markdown Conversion ===")
+        ocr_output_file, markdown_content = asyncio.run(
+            run_pipeline(folder_path, gemini_model, gemini_client)
+        )
+        print(f"OCR output saved to: {ocr_output_file}")
 
-        result = subprocess.run(markdown_cmd, check=True)
-        print("Markdown processing completed successfully!")
+        if not markdown_content:
+            print("Warning: No text extracted from images")
+            return
+
+        # Step 2: Save markdown
+        print("\n=== Step 2: Saving Markdown ===")
+        md_file = txt2md.save_markdown(gemini_client, markdown_content, output_folder, args.output_name)
+        print(f"Markdown file created: {md_file}")
 
         print(f"\n=== Processing Complete ===")
         print(f"All files saved in: {args.folder_path}")
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error running subprocess: {e}")
-        sys.exit(1)
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
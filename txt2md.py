@@ -6,51 +6,118 @@ Kindle Markdown Processing Script
 Converts OCR text to markdown format using Google Gemini API and uploads to Google Drive.
 """
 
+import re
 import sys
+import asyncio
 import argparse
 import shutil
 from pathlib import Path
+import httpx
 from google import genai
+from google.genai import errors, types
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+from config import load_config
 
 # Constants
 GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
 
-def load_config(config_path='config.env'):
-    """Load configuration from config.env file."""
-    config = {}
-    config_file = Path(config_path)
+# Idle connections kept open to the Gemini API for reuse across requests
+MAX_KEEPALIVE_CONNECTIONS = 32
 
-    if not config_file.exists():
-        return config
+# Number of OCR pages converted to Markdown per Gemini request when pipelining
+DEFAULT_PAGES_PER_CHUNK = 20
 
-    try:
-        with open(config_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    # Remove quotes if present
-                    value = value.strip().strip('"').strip("'")
-                    config[key.strip()] = value
-    except Exception as e:
-        print(f"Warning: Could not read config file {config_path}: {e}")
+# Longer OCR text is split into chunks of about this many tokens, converted concurrently
+DEFAULT_CHUNK_TOKENS = 4000
+
+# Maximum number of Markdown chunk requests in flight at once
+DEFAULT_CONCURRENCY = 8
+
+# Attempts per Gemini request when it fails with a rate limit or server error
+MAX_ATTEMPTS = 5
+
+# Transient Gemini API error codes worth retrying: 429 rate limits and 5xx server
+# errors, but not 501 Not Implemented
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+MARKDOWN_PROMPT = """Convert the following extracted text into well-formatted Markdown:
+
+{ocr_text}
+
+Rules:
+- Use proper heading levels (# ## ###) for titles and chapter names
+- The text may be one part of a longer book; use # only for the book title, ## for chapters and ### for sections so that parts join consistently
+- Format paragraphs with proper line breaks
+- Use **bold** for emphasis where appropriate
+- Use > blockquotes for important quotes or highlighted text
+- Maintain the original text structure and flow
+- Do not add any content that wasn't in the original text
+- Return only the Markdown-formatted content without explanations
+
+Markdown:"""
+
+
+class SafeFilenameTable(dict):
+    """str.translate table that keeps letters, digits, spaces, hyphens and underscores.
+
+    Every other character maps to '_'. Entries are computed on first use and
+    cached, so any Unicode letter (e.g. Japanese titles) is handled too.
+    """
 
-    return config
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        self[codepoint] = codepoint if char.isalnum() or char in ' -_' else '_'
+        return self[codepoint]
+
+
+SAFE_FILENAME_TABLE = SafeFilenameTable()
 
 
 def setup_gemini_client(api_key):
-    """Set up Google Gemini client."""
+    """Set up Google Gemini client.
+
+    The client's sync and async httpx clients use HTTP/2, so concurrent
+    requests are multiplexed over shared connections. Only keyword arguments
+    are passed, so httpx still honours proxy environment variables and genai
+    still applies its SSL context.
+    """
     if not api_key:
         raise ValueError("Gemini API key is required")
 
-    client = genai.Client(api_key=api_key)
+    limits = httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+    http_options = types.HttpOptions(
+        client_args={'http2': True, 'limits': limits},
+        async_client_args={'http2': True, 'limits': limits},
+    )
+    client = genai.Client(api_key=api_key, http_options=http_options)
     return client
 
 
-def generate_filename_from_text(gemini_client, text_content):
-    """Generate a descriptive filename from text content using Gemini."""
-    try:
-        filename_prompt = f"""Based on this text content, generate a concise but descriptive filename for this document.
+def is_retryable(error):
+    """Return True for transient Gemini API errors (see RETRYABLE_CODES)."""
+    return isinstance(error, errors.APIError) and error.code in RETRYABLE_CODES
+
+
+def log_retry(retry_state):
+    """Report a transient Gemini error before tenacity waits to retry it."""
+    print(f"Gemini request failed ({retry_state.outcome.exception()}); "
+          f"retrying in {retry_state.next_action.sleep:.1f}s "
+          f"(attempt {retry_state.attempt_number}/{MAX_ATTEMPTS})")
+
+
+# Retries rate limit (429) and server (5xx) errors with exponential backoff and
+# jitter; other errors are raised immediately
+retry_transient_errors = retry(
+    retry=retry_if_exception(is_retryable), stop=stop_after_attempt(MAX_ATTEMPTS),
+    wait=wait_exponential_jitter(), before_sleep=log_retry, reraise=True
+)
+
+
+@retry_transient_errors
+def request_filename(gemini_client, text_content):
+    """Ask Gemini for a filename for text content, returning the response."""
+    filename_prompt = f"""Based on this text content, generate a concise but descriptive filename for this document.
 
 {text_content[:1000]}...
 
@@ -63,22 +130,21 @@ Rules:
 
 Filename:"""
 
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=filename_prompt
-        )
+    return gemini_client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=filename_prompt
+    )
+
+
+def generate_filename_from_text(gemini_client, text_content):
+    """Generate a descriptive filename from text content using Gemini."""
+    try:
+        response = request_filename(gemini_client, text_content)
 
         if response.text:
             filename = response.text.strip()
             # Clean up the filename
-            safe_chars = []
-            for char in filename:
-                if char.isalnum() or char in ' -_':
-                    safe_chars.append(char)
-                else:
-                    safe_chars.append('_')
-
-            result = ''.join(safe_chars).strip()
+            result = filename.translate(SAFE_FILENAME_TABLE).strip()
             return result if result else 'OCR_Output'
         else:
             return 'OCR_Output'
@@ -88,94 +154,212 @@ Filename:"""
         return 'OCR_Output'
 
 
+@retry_transient_errors
+async def convert_to_markdown(gemini_client, ocr_text):
+    """Convert OCR text to Markdown with a single Gemini request.
 
+    Rate limit (429) and server (5xx) errors are retried with exponential
+    backoff and jitter; other errors are raised immediately.
+    """
+    response = await gemini_client.aio.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=MARKDOWN_PROMPT.format(ocr_text=ocr_text)
+    )
 
-def main():
-    parser = argparse.ArgumentParser(description='Convert OCR text to Markdown and upload to Google Drive')
-    parser.add_argument('ocr_file', help='Path to OCR text file (e.g., ocr_output.txt)')
-    parser.add_argument('--gemini-api-key', required=False,
-                       help='Google Gemini API key (defaults to config.env)')
-    parser.add_argument('--output-name', required=False,
-                       help='Custom filename for output files (without extension)')
+    if not response.text:
+        raise ValueError("Failed to generate markdown content")
 
-    args = parser.parse_args()
+    return response.text.strip()
+
+
+@retry_transient_errors
+async def count_tokens(gemini_client, text):
+    """Count the tokens in text with Gemini's tokenizer."""
+    response = await gemini_client.aio.models.count_tokens(model=GEMINI_MODEL, contents=text)
+    return response.total_tokens or 0
+
+
+async def split_by_tokens(gemini_client, text, max_tokens=DEFAULT_CHUNK_TOKENS):
+    """Split text into chunks of at most about max_tokens tokens at paragraph boundaries.
+
+    The whole text is counted once with Gemini's tokenizer and the chunk size
+    in characters is derived from that ratio. Paragraphs longer than a chunk
+    are split at line breaks.
+    """
+    total_tokens = await count_tokens(gemini_client, text)
+    if total_tokens <= max_tokens:
+        return [text]
+
+    max_chars = max(1, len(text) * max_tokens // total_tokens)
+
+    # Split after blank lines, and after every line inside over-long paragraphs,
+    # keeping the separators so the chunks join back into the original text
+    blocks = []
+    for paragraph in re.split(r'(?<=\n\n)', text):
+        if len(paragraph) > max_chars:
+            blocks.extend(re.split(r'(?<=\n)', paragraph))
+        else:
+            blocks.append(paragraph)
+
+    chunks = []
+    chunk = []
+    chunk_chars = 0
+    for block in blocks:
+        if chunk and chunk_chars + len(block) > max_chars:
+            chunks.append(''.join(chunk))
+            chunk = []
+            chunk_chars = 0
+        chunk.append(block)
+        chunk_chars += len(block)
+    if chunk:
+        chunks.append(''.join(chunk))
+    return chunks
+
+
+async def convert_text(gemini_client, ocr_text, max_tokens=DEFAULT_CHUNK_TOKENS,
+                       concurrency=DEFAULT_CONCURRENCY):
+    """Convert OCR text to Markdown, converting chunks of long text concurrently.
+
+    The text is split into chunks of about ``max_tokens`` tokens, at most
+    ``concurrency`` chunks are sent to Gemini at a time, and the converted
+    chunks are joined in order.
+    """
+    chunks = await split_by_tokens(gemini_client, ocr_text, max_tokens)
+    if len(chunks) > 1:
+        print(f"Converting {len(chunks)} chunks concurrently")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def convert_chunk(chunk):
+        async with semaphore:
+            return await convert_to_markdown(gemini_client, chunk)
+
+    results = await asyncio.gather(*[convert_chunk(chunk) for chunk in chunks])
+    return '\n\n'.join(results)
+
+
+async def convert_pages(gemini_client, pages, pages_per_chunk=DEFAULT_PAGES_PER_CHUNK,
+                        concurrency=DEFAULT_CONCURRENCY):
+    """Convert OCR pages to Markdown while they are still being produced.
+
+    ``pages`` is an asyncio.Queue of page texts in page order, ended by None.
+    Every ``pages_per_chunk`` pages are sent to Gemini as one request as soon
+    as they are available, with at most ``concurrency`` requests in flight at
+    a time, and the converted chunks are joined in order.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def convert_chunk(chunk):
+        async with semaphore:
+            return await convert_to_markdown(gemini_client, '\n'.join(chunk))
+
+    tasks = []
+    chunk = []
+    while True:
+        text_content = await pages.get()
+        if text_content is None:
+            break
+        chunk.append(text_content)
+        if len(chunk) == pages_per_chunk:
+            tasks.append(asyncio.create_task(convert_chunk(chunk)))
+            chunk = []
+
+    if chunk:
+        tasks.append(asyncio.create_task(convert_chunk(chunk)))
 
     try:
-        # Load configuration
-        config = load_config()
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return '\n\n'.join(results)
 
-        # Setup
-        ocr_file_path = Path(args.ocr_file)
-        if not ocr_file_path.exists():
-            raise FileNotFoundError(f"OCR file not found: {ocr_file_path}")
 
-        print(f"Processing OCR file: {ocr_file_path}")
+def save_markdown(gemini_client, markdown_content, output_folder, output_name=None):
+    """Save Markdown content in output_folder, naming it from its content unless output_name is given."""
+    # Generate filename from markdown content (unless custom name provided)
+    if output_name:
+        filename = output_name
+    else:
+        # Use first few lines of markdown for filename generation
+        first_lines = '\n'.join(markdown_content.split('\n')[:10])
+        filename = generate_filename_from_text(gemini_client, first_lines)
 
-        # Get API key from args or config
-        api_key = args.gemini_api_key or config.get('GEMINI_API_KEY')
-        if not api_key:
-            raise ValueError("Gemini API key is required. Set it in config.env or use --gemini-api-key")
+    print(f"Using filename: {filename}")
 
-        # Initialize Google Gemini API
-        gemini_client = setup_gemini_client(api_key)
+    output_folder_path = Path(output_folder)
+    if not output_folder_path.exists():
+        output_folder_path.mkdir(parents=True, exist_ok=True)
+        print(f"Created output folder: {output_folder_path}")
 
-        # Read OCR text
-        with open(ocr_file_path, 'r', encoding='utf-8') as f:
-            ocr_text = f.read().strip()
+    md_file = output_folder_path / f"{filename}.md"
+    with open(md_file, 'w', encoding='utf-8') as f:
+        f.write(markdown_content)
 
-        if not ocr_text:
-            print("Warning: OCR file is empty")
-            return
+    return md_file
 
-        # Convert OCR text to markdown
-        markdown_prompt = f"""Convert the following extracted text into well-formatted Markdown:
 
-{ocr_text}
+def run(ocr_file, api_key=None, gemini_client=None, output_name=None, output_folder=None):
+    """Convert an OCR text file to Markdown and return the created file, or None if it is empty.
 
-Rules:
-- Use proper heading levels (# ## ###) for titles and chapter names
-- Format paragraphs with proper line breaks
-- Use **bold** for emphasis where appropriate
-- Use > blockquotes for important quotes or highlighted text
-- Maintain the original text structure and flow
-- Do not add any content that wasn't in the original text
-- Return only the Markdown-formatted content without explanations
+    Errors are raised rather than exiting, so other scripts can call this
+    in-process. Pass ``gemini_client`` to reuse an already configured client;
+    otherwise one is set up from ``api_key`` or config.env. The Markdown file
+    is saved in ``output_folder``, defaulting to GOOGLE_DRIVE_FOLDER.
+    """
+    # Load configuration
+    config = load_config()
 
-Markdown:"""
+    # Setup
+    ocr_file_path = Path(ocr_file)
+    if not ocr_file_path.exists():
+        raise FileNotFoundError(f"OCR file not found: {ocr_file_path}")
+
+    print(f"Processing OCR file: {ocr_file_path}")
+
+    if gemini_client is None:
+        # Get API key from args or config
+        api_key = api_key or config.get('GEMINI_API_KEY')
+        if not api_key:
+            raise ValueError("Gemini API key is required. Set it in config.env or use --gemini-api-key")
 
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=markdown_prompt
-        )
+        # Initialize Google Gemini API
+        gemini_client = setup_gemini_client(api_key)
 
-        if not response.text:
-            raise ValueError("Failed to generate markdown content")
+    # Read OCR text
+    with open(ocr_file_path, 'r', encoding='utf-8') as f:
+        ocr_text = f.read().strip()
 
-        markdown_content = response.text.strip()
+    if not ocr_text:
+        print("Warning: OCR file is empty")
+        return None
 
-        # Generate filename from markdown content (unless custom name provided)
-        if args.output_name:
-            filename = args.output_name
-        else:
-            # Use first few lines of markdown for filename generation
-            first_lines = '\n'.join(markdown_content.split('\n')[:10])
-            filename = generate_filename_from_text(gemini_client, first_lines)
+    # Save directly to Google Drive folder
+    output_folder = output_folder or config.get('GOOGLE_DRIVE_FOLDER')
+    if not output_folder:
+        raise ValueError("GOOGLE_DRIVE_FOLDER must be set in config.env")
 
-        print(f"Using filename: {filename}")
+    # Convert OCR text to markdown
+    markdown_content = asyncio.run(convert_text(gemini_client, ocr_text))
 
-        # Save directly to Google Drive folder
-        drive_folder = config.get('GOOGLE_DRIVE_FOLDER')
-        if not drive_folder:
-            raise ValueError("GOOGLE_DRIVE_FOLDER must be set in config.env")
+    return save_markdown(gemini_client, markdown_content, output_folder, output_name)
 
-        drive_folder_path = Path(drive_folder)
-        if not drive_folder_path.exists():
-            drive_folder_path.mkdir(parents=True, exist_ok=True)
-            print(f"Created Google Drive folder: {drive_folder_path}")
 
-        md_file = drive_folder_path / f"{filename}.md"
-        with open(md_file, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
+def main():
+    parser = argparse.ArgumentParser(description='Convert OCR text to Markdown and upload to Google Drive')
+    parser.add_argument('ocr_file', help='Path to OCR text file (e.g., ocr_output.txt)')
+    parser.add_argument('--gemini-api-key', required=False,
+                       help='Google Gemini API key (defaults to config.env)')
+    parser.add_argument('--output-name', required=False,
+                       help='Custom filename for output files (without extension)')
+
+    args = parser.parse_args()
+
+    try:
+        md_file = run(args.ocr_file, args.gemini_api_key, output_name=args.output_name)
+        if md_file is None:
+            return
 
         print(f"Markdown file created in Google Drive: {md_file}")
         print(f"\nProcessing completed successfully!")